@@ -1,11 +1,19 @@
 import os
+import sys
 import smtplib
 import ssl
 import time
 import logging
+import threading
+import math
+import json
+import functools
+from contextlib import contextmanager
+import cProfile
 import sqlite3  # Use sqlite3 for demo; code is compatible with PostgreSQL/MySQL via DB-API 2.0
 from email.message import EmailMessage
 from email.utils import formataddr, make_msgid
+from datetime import date, datetime, timedelta
 from typing import List, Optional, Dict, Any, Tuple
 from html import unescape
 import re
@@ -26,7 +34,449 @@ if not logger.hasHandlers():
     logger.addHandler(handler)
 logger.setLevel(logging.INFO)
 
+# --- PROFILING ---
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+# From 3.12 cProfile hooks sys.monitoring: one enabled Profile sees every thread and
+# can be disabled from any thread. Before that it only sees the thread that enabled it.
+_CPROFILE_ALL_THREADS = sys.version_info >= (3, 12)
+
+class PipelineProfiler:
+    """Profiles the render/send pipeline over a window of `sends` completed send_email calls.
+
+    Time spent inside functions wrapped with @profiled_stage is attributed to the stage name.
+    'sample' mode walks the stacks of threads inside a stage every `interval` seconds and
+    writes collapsed stacks (flamegraph.pl / speedscope); 'cprofile' mode writes a .prof file.
+    cProfile is enabled while one thread (the owner) is inside a stage: before Python 3.12
+    that records only the owner, from 3.12 it records every thread during that time.
+    The profiler stops itself after `sends` sends or `max_seconds`, whichever comes first.
+    """
+
+    def __init__(self, sends: int = 100, mode: str = 'sample', interval: float = 0.005,
+                 output_dir: Optional[str] = None, max_seconds: float = 300.0):
+        if mode not in ('sample', 'cprofile'):
+            raise ValueError(f"Unknown profiling mode: {mode}")
+        if sends < 1:
+            raise ValueError('sends must be at least 1')
+        self.sends = sends
+        self.mode = mode
+        self.interval = interval
+        self.output_dir = output_dir or PROFILE_DIR
+        self.max_seconds = max_seconds
+        self.completed_sends = 0
+        self.stage_times: Dict[str, List[float]] = {}
+        self.samples: Dict[str, int] = {}
+        self.outputs: Dict[str, str] = {}
+        self._stacks: Dict[int, List[str]] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._started = time.monotonic()
+        self._cprofile = cProfile.Profile() if mode == 'cprofile' else None
+        self._cprofile_owner: Optional[int] = None
+        self._base: Optional[str] = None
+        self._sampler: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._started = time.monotonic()
+        self._sampler = threading.Thread(target=self._run_sampler, name='pipeline-profiler', daemon=True)
+        self._sampler.start()
+
+    def enter_stage(self, name: str) -> float:
+        tid = threading.get_ident()
+        stack = self._stacks.setdefault(tid, [])
+        stack.append(name)
+        if self._cprofile is not None and len(stack) == 1:
+            with self._lock:
+                if self._cprofile_owner is None and not self._stopped.is_set():
+                    try:
+                        self._cprofile.enable()
+                        self._cprofile_owner = tid
+                    except ValueError as e:
+                        # Another profiler (e.g. a debugger) already holds the hook.
+                        logger.warning(f"cProfile unavailable, skipping: {e}")
+        return time.perf_counter()
+
+    def exit_stage(self, name: str, started: float) -> None:
+        elapsed = time.perf_counter() - started
+        tid = threading.get_ident()
+        stack = self._stacks.get(tid)
+        if stack:
+            stack.pop()
+        finished = False
+        deferred_dump = False
+        with self._lock:
+            totals = self.stage_times.setdefault(name, [0, 0.0])
+            totals[0] += 1
+            totals[1] += elapsed
+            if self._cprofile_owner == tid and not stack:
+                self._cprofile.disable()
+                self._cprofile_owner = None
+                deferred_dump = self._stopped.is_set()
+            if name == 'send_email' and not stack:
+                self.completed_sends += 1
+                finished = self.completed_sends >= self.sends
+        if deferred_dump:
+            self._dump_cprofile()
+        elif finished:
+            self.stop()
+
+    def _run_sampler(self) -> None:
+        while not self._stopped.wait(self.interval):
+            if time.monotonic() - self._started >= self.max_seconds:
+                self.stop()
+                return
+            if self.mode == 'sample':
+                self._take_sample()
+
+    def _take_sample(self) -> None:
+        frames = sys._current_frames()
+        for tid, stack in list(self._stacks.items()):
+            stages = list(stack)
+            frame = frames.get(tid)
+            if not stages or frame is None:
+                continue
+            names = []
+            while frame is not None and len(names) < 256:
+                code = frame.f_code
+                if code is _STAGE_WRAPPER_CODE:
+                    names.append(None)
+                else:
+                    names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            names.reverse()
+            # Stage wrapper frames appear root-first in the same order as the stage stack.
+            stage_iter = iter(stages)
+            key = ';'.join(f"[{next(stage_iter, '?')}]" if n is None else n for n in names)
+            with self._lock:
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def stop(self) -> Dict[str, str]:
+        global _active_profiler
+        if _active_profiler is self:
+            _active_profiler = None
+        with self._lock:
+            if self._stopped.is_set():
+                return self.outputs
+            self._stopped.set()
+            self._base = os.path.join(self.output_dir, f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}")
+            owner = self._cprofile_owner
+            if owner is not None and (owner == threading.get_ident() or _CPROFILE_ALL_THREADS):
+                self._cprofile.disable()
+                self._cprofile_owner = None
+                owner = None
+            stage_times = {name: list(totals) for name, totals in self.stage_times.items()}
+        if self._sampler is not None and self._sampler is not threading.current_thread():
+            self._sampler.join()
+        with self._lock:
+            samples = dict(self.samples)
+        self._dump(stage_times, samples)
+        if self._cprofile is not None and owner is None:
+            self._dump_cprofile()
+        # Otherwise another thread still has cProfile enabled (pre-3.12 only it can disable
+        # it); that thread writes the .prof when its stage ends instead of blocking here.
+        return self.outputs
+
+    def _dump(self, stage_times: Dict[str, List[float]], samples: Dict[str, int]) -> None:
+        # Runs inside the send_email wrapper; a failed write must never fail a delivered send.
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            if self.mode == 'sample':
+                path = self._base + '.collapsed'
+                with open(path, 'w', encoding='utf-8') as f:
+                    for stack, count in sorted(samples.items()):
+                        f.write(f"{stack} {count}\n")
+                self.outputs['collapsed'] = path
+            path = self._base + '.stages.txt'
+            with open(path, 'w', encoding='utf-8') as f:
+                for name, (count, total) in sorted(stage_times.items(), key=lambda item: -item[1][1]):
+                    f.write(f"{name}\t{count}\t{total:.6f}\n")
+            self.outputs['stages'] = path
+        except Exception as e:
+            logger.error(f"Could not write profile to {self.output_dir}: {e}")
+            return
+        logger.info(f"Profiling finished after {self.completed_sends} sends: {self.outputs}")
+
+    def _dump_cprofile(self) -> None:
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            path = self._base + '.prof'
+            self._cprofile.dump_stats(path)
+        except Exception as e:
+            logger.error(f"Could not write cProfile stats to {self.output_dir}: {e}")
+            return
+        self.outputs['cprofile'] = path
+        logger.info(f"cProfile stats written to {path}")
+
+_active_profiler: Optional[PipelineProfiler] = None
+
+def enable_profiling(**kwargs: Any) -> PipelineProfiler:
+    global _active_profiler
+    if _active_profiler is not None:
+        raise RuntimeError('Profiling is already enabled')
+    profiler = PipelineProfiler(**kwargs)
+    profiler.start()
+    _active_profiler = profiler
+    logger.info(f"Profiling enabled ({profiler.mode}) for {profiler.sends} sends")
+    return profiler
+
+def disable_profiling() -> Dict[str, str]:
+    profiler = _active_profiler
+    if profiler is None:
+        return {}
+    return profiler.stop()
+
+def profiled_stage(name: str):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _active_profiler
+            if profiler is None:
+                return func(*args, **kwargs)
+            started = profiler.enter_stage(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.exit_stage(name, started)
+        return wrapper
+    return decorator
+
+_STAGE_WRAPPER_CODE = profiled_stage('')(lambda: None).__code__
+
+def _profiling_from_env() -> Optional[PipelineProfiler]:
+    # Never let a bad profiling flag stop the service from starting.
+    value = os.getenv('EMAIL_PROFILE', '').strip().lower()
+    if value in ('', '0', 'false', 'no', 'off'):
+        return None
+    mode = 'sample' if value in ('1', 'true', 'yes', 'on') else value
+    try:
+        return enable_profiling(mode=mode,
+                                sends=int(os.getenv('EMAIL_PROFILE_SENDS', '100')),
+                                output_dir=os.getenv('EMAIL_PROFILE_DIR'))
+    except (ValueError, RuntimeError) as e:
+        logger.warning(f"Ignoring EMAIL_PROFILE={value!r}: {e}")
+        return None
+
+_profiling_from_env()
+
+# --- ADAPTIVE THROTTLING ---
+# Relays signal overload with 421 (service not available) and 451 (local error / try later).
+THROTTLE_CODES = frozenset({421, 451})
+
+def _smtp_reply_code(exc: BaseException) -> Optional[int]:
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return exc.smtp_code
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in exc.recipients.values()]
+        throttled = [code for code in codes if code in THROTTLE_CODES]
+        return throttled[0] if throttled else (codes[0] if codes else None)
+    return None
+
+class AdaptiveThrottle:
+    """AIMD controller for the parallelism and send rate allowed against one relay.
+
+    Throttling replies (421/451) cut both limits multiplicatively, at most once per
+    cooldown window; healthy replies under the latency target grow them additively.
+    """
+
+    def __init__(self,
+                 max_concurrency: int = 8,
+                 min_concurrency: int = 1,
+                 max_rate: float = 50.0,
+                 min_rate: float = 0.5,
+                 decrease_factor: float = 0.5,
+                 rate_step: float = 0.5,
+                 latency_target: float = 5.0,
+                 cooldown: float = 1.0):
+        if min_concurrency < 1 or max_concurrency < min_concurrency:
+            raise ValueError('Invalid concurrency bounds')
+        if min_rate <= 0 or max_rate < min_rate:
+            raise ValueError('Invalid rate bounds')
+        if not 0 < decrease_factor < 1:
+            raise ValueError('decrease_factor must be between 0 and 1')
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.decrease_factor = decrease_factor
+        self.rate_step = rate_step
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.concurrency = float(max_concurrency)
+        self.rate = float(max_rate)
+        self.in_flight = 0
+        self._next_slot = 0.0
+        self._last_decrease = float('-inf')
+        self._cond = threading.Condition()
+
+    def update_bounds(self, max_concurrency: Optional[int] = None, max_rate: Optional[float] = None) -> None:
+        with self._cond:
+            max_concurrency = self.max_concurrency if max_concurrency is None else max_concurrency
+            max_rate = self.max_rate if max_rate is None else max_rate
+            if max_concurrency < self.min_concurrency:
+                raise ValueError('Invalid concurrency bounds')
+            if max_rate < self.min_rate:
+                raise ValueError('Invalid rate bounds')
+            if (max_concurrency, max_rate) == (self.max_concurrency, self.max_rate):
+                return
+            logger.info(f"Relay throttle bounds changed: concurrency<={max_concurrency} rate<={max_rate}/s")
+            self.max_concurrency = max_concurrency
+            self.max_rate = max_rate
+            self.concurrency = min(self.concurrency, float(max_concurrency))
+            self.rate = min(self.rate, float(max_rate))
+            self._cond.notify_all()
+
+    def acquire(self) -> None:
+        with self._cond:
+            while self.in_flight >= int(self.concurrency):
+                self._cond.wait()
+            self.in_flight += 1
+            now = time.monotonic()
+            start = max(now, self._next_slot)
+            self._next_slot = start + 1.0 / self.rate
+        delay = start - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def release(self, code: Optional[int], latency: float) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            if code in THROTTLE_CODES:
+                self._decrease(code)
+            elif code is not None and 200 <= code < 300 and latency <= self.latency_target:
+                self._increase()
+            self._cond.notify_all()
+
+    def _decrease(self, code: int) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.concurrency = max(float(self.min_concurrency), self.concurrency * self.decrease_factor)
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self._next_slot = max(self._next_slot, now + 1.0 / self.rate)
+        logger.warning(f"Relay throttled ({code}); concurrency={int(self.concurrency)} rate={self.rate:.2f}/s")
+
+    def _increase(self) -> None:
+        # Roughly +1 slot per full window of healthy replies, as in TCP congestion avoidance.
+        self.concurrency = min(float(self.max_concurrency), self.concurrency + 1.0 / self.concurrency)
+        self.rate = min(self.max_rate, self.rate + self.rate_step)
+
+_relay_throttles: Dict[Tuple[str, int], AdaptiveThrottle] = {}
+_relay_throttles_lock = threading.Lock()
+
+def get_relay_throttle(host: str, port: int, **kwargs: Any) -> AdaptiveThrottle:
+    # One throttle per relay. Later callers keep the learned state but apply their
+    # max_concurrency/max_rate, so the most recent settings win; other kwargs only
+    # take effect on creation.
+    with _relay_throttles_lock:
+        throttle = _relay_throttles.get((host, port))
+        if throttle is None:
+            throttle = AdaptiveThrottle(**kwargs)
+            _relay_throttles[(host, port)] = throttle
+        else:
+            throttle.update_bounds(kwargs.get('max_concurrency'), kwargs.get('max_rate'))
+        return throttle
+
+# --- PIPELINED SMTP TRANSPORT ---
+def _to_crlf(data: bytes) -> bytes:
+    return re.sub(rb'(?:\r\n|\n|\r(?!\n))', b'\r\n', data)
+
+class _PipeliningMixin:
+    """Batches the envelope of each transaction when the relay advertises PIPELINING (RFC 2920).
+
+    MAIL FROM, every RCPT TO and DATA go out in one write and their replies are read back
+    in order. If CHUNKING (RFC 3030) is also advertised, the body is sent as a single
+    BDAT LAST chunk in that same write, so a message on an already open session
+    (see EmailSender.session) costs one round trip.
+    Relays without PIPELINING fall back to the stock lock-step smtplib behaviour.
+    """
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+        self.ehlo_or_helo_if_needed()
+        if not self.has_extn('pipelining'):
+            return super().sendmail(from_addr, to_addrs, msg, mail_options, rcpt_options)
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        if isinstance(msg, str):
+            msg = msg.encode('ascii')
+        payload = _to_crlf(msg)
+        options = list(mail_options)
+        if self.has_extn('size'):
+            options.append(f'SIZE={len(payload)}')
+        encoding = 'ascii'
+        if any(option.lower() == 'smtputf8' for option in options):
+            if not self.has_extn('smtputf8'):
+                raise smtplib.SMTPNotSupportedError('SMTPUTF8 not supported by server')
+            encoding = 'utf-8'
+        chunking = self.has_extn('chunking')
+        lines = [f"MAIL FROM:{smtplib.quoteaddr(from_addr)}{''.join(' ' + o for o in options)}"]
+        rcpt_suffix = ''.join(' ' + o for o in rcpt_options)
+        lines += [f"RCPT TO:{smtplib.quoteaddr(rcpt)}{rcpt_suffix}" for rcpt in to_addrs]
+        lines.append(f'BDAT {len(payload)} LAST' if chunking else 'DATA')
+        batch = b''.join(line.encode(encoding) + b'\r\n' for line in lines)
+        self.send(batch + payload if chunking else batch)
+
+        # Replies are checked as they arrive: a relay answering 421 closes the connection
+        # straight after, so the remaining replies of the batch will never come.
+        mail_code, mail_resp = self.getreply()
+        if mail_code == 421:
+            self.close()
+            raise smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr)
+        self.rcpt_replies = {}
+        refused = {}
+        for rcpt in to_addrs:
+            code, resp = self.getreply()
+            self.rcpt_replies[rcpt] = (code, resp)
+            if code not in (250, 251):
+                refused[rcpt] = (code, resp)
+            if code == 421:
+                self.close()
+                raise smtplib.SMTPRecipientsRefused(refused)
+        data_code, data_resp = self.getreply()
+        if data_code == 421:
+            self.close()
+            raise smtplib.SMTPDataError(data_code, data_resp)
+
+        if not chunking and data_code == 354 and (mail_code != 250 or len(refused) == len(to_addrs)):
+            # Relay opened DATA despite a failed envelope; close it with an empty body.
+            self.send(b'.\r\n')
+            data_code, data_resp = self.getreply()
+        if mail_code != 250:
+            self._abort_transaction(mail_code)
+            raise smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr)
+        if len(refused) == len(to_addrs):
+            self._abort_transaction(data_code)
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if not chunking:
+            if data_code != 354:
+                self._abort_transaction(data_code)
+                raise smtplib.SMTPDataError(data_code, data_resp)
+            body = re.sub(rb'(?m)^\.', b'..', payload)
+            if not body.endswith(b'\r\n'):
+                body += b'\r\n'
+            self.send(body + b'.\r\n')
+            data_code, data_resp = self.getreply()
+        if data_code != 250:
+            self._abort_transaction(data_code)
+            raise smtplib.SMTPDataError(data_code, data_resp)
+        return refused
+
+    def _abort_transaction(self, code: int) -> None:
+        if code == 421:
+            self.close()
+            return
+        try:
+            self.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+class PipeliningSMTP(_PipeliningMixin, smtplib.SMTP):
+    pass
+
+class PipeliningSMTP_SSL(_PipeliningMixin, smtplib.SMTP_SSL):
+    pass
+
 # --- EMAIL SENDER ---
+@profiled_stage('html_to_text')
 def html_to_text(html: str) -> str:
     html = re.sub(r'<(script|style)[^>]*>.*?</\\1>', '', html, flags=re.DOTALL|re.IGNORECASE)
     html = re.sub(r'<br[ \\t\\r\\n]*/*>', '\\n', html, flags=re.IGNORECASE)
@@ -44,13 +494,21 @@ class EmailSender:
         self.smtp_password = os.getenv('SMTP_PASSWORD')
         self.use_tls = os.getenv('SMTP_USE_TLS', 'false').lower() == 'true'
         self.use_ssl = os.getenv('SMTP_USE_SSL', 'false').lower() == 'true'
+        self.use_pipelining = os.getenv('SMTP_PIPELINING', 'false').lower() == 'true'
         self.from_email = os.getenv('FROM_EMAIL')
         self.from_name = os.getenv('FROM_NAME', '')
         if not self.from_email:
             raise RuntimeError('FROM_EMAIL must be set')
         if not self.from_email.lower().startswith('no-reply'):
             raise RuntimeError('FROM_EMAIL must be a no-reply address')
+        self.throttle = get_relay_throttle(
+            self.smtp_host, self.smtp_port,
+            max_concurrency=int(os.getenv('SMTP_MAX_CONCURRENCY', '8')),
+            max_rate=float(os.getenv('SMTP_MAX_RATE', '50')),
+        )
+        self._local = threading.local()
 
+    @profiled_stage('send_email')
     def send_email(self,
                    to: List[str],
                    subject: str,
@@ -76,31 +534,74 @@ class EmailSender:
         msg.add_alternative(html_body, subtype='html')
         attempt = 0
         while True:
+            self.throttle.acquire()
+            started = time.monotonic()
+            code = None
+            error = None
             try:
                 self._send(msg)
+                code = 250
+            except (smtplib.SMTPException, OSError) as e:
+                code = _smtp_reply_code(e)
+                error = e
+            finally:
+                # Always hand the slot back, including on unexpected errors (code stays None).
+                self.throttle.release(code, time.monotonic() - started)
+            if error is None:
                 logger.info(f"Email sent to {to}")
                 break
-            except (smtplib.SMTPException, OSError) as e:
-                attempt += 1
-                logger.warning(f"Send attempt {attempt} failed: {e}")
-                if attempt >= max_retries:
-                    logger.error(f"Giving up after {attempt} attempts.")
-                    raise
-                time.sleep(backoff * attempt)
+            attempt += 1
+            logger.warning(f"Send attempt {attempt} failed: {error}")
+            if attempt >= max_retries:
+                logger.error(f"Giving up after {attempt} attempts.")
+                raise error
+            time.sleep(backoff * attempt)
 
-    def _send(self, msg: EmailMessage) -> None:
+    @contextmanager
+    def session(self):
+        """Reuses one SMTP connection for every send_email call made in this thread inside the block.
+
+        Connect, EHLO, STARTTLS and AUTH are paid once per session instead of once per message;
+        if the relay drops the connection (e.g. after a 421) the next send reconnects.
+        """
+        self._local.server = self._open()
+        try:
+            yield self
+        finally:
+            server, self._local.server = self._local.server, None
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                server.close()
+
+    def _open(self):
         if self.use_ssl:
             context = ssl.create_default_context()
-            with smtplib.SMTP_SSL(self.smtp_host, self.smtp_port, context=context) as server:
-                self._login(server)
-                server.send_message(msg)
+            transport = PipeliningSMTP_SSL if self.use_pipelining else smtplib.SMTP_SSL
+            server = transport(self.smtp_host, self.smtp_port, context=context)
         else:
-            with smtplib.SMTP(self.smtp_host, self.smtp_port) as server:
-                if self.use_tls:
-                    context = ssl.create_default_context()
-                    server.starttls(context=context)
-                self._login(server)
+            transport = PipeliningSMTP if self.use_pipelining else smtplib.SMTP
+            server = transport(self.smtp_host, self.smtp_port)
+        try:
+            if self.use_tls and not self.use_ssl:
+                context = ssl.create_default_context()
+                server.starttls(context=context)
+            self._login(server)
+        except BaseException:
+            server.close()
+            raise
+        return server
+
+    @profiled_stage('smtp')
+    def _send(self, msg: EmailMessage) -> None:
+        server = getattr(self._local, 'server', None)
+        if server is None:
+            with self._open() as server:
                 server.send_message(msg)
+            return
+        if server.sock is None:
+            server = self._local.server = self._open()
+        server.send_message(msg)
 
     def _login(self, server):
         if self.smtp_username and self.smtp_password:
@@ -122,6 +623,7 @@ class SQLDataAccess:
         else:
             raise NotImplementedError('Only SQLite is implemented in this example. Use DB-API 2.0 for other engines.')
 
+    @profiled_stage('sql')
     def get_user_by_id(self, user_id: int) -> Optional[Dict[str, Any]]:
         cur = self.conn.cursor()
         cur.execute("SELECT id, email, name, subscription_status, last_payment_date FROM users WHERE id = ?", (user_id,))
@@ -140,6 +642,7 @@ class SQLDataAccess:
         self.conn.close()
 
 # --- EMAIL TEMPLATES ---
+@profiled_stage('render')
 def render_welcome_email(user: Dict[str, Any]) -> Tuple[str, str]:
     html = f"""
     <html><body>
@@ -161,6 +664,7 @@ def render_welcome_email(user: Dict[str, Any]) -> Tuple[str, str]:
     """
     return html, plain
 
+@profiled_stage('render')
 def render_payment_confirmation_email(user: Dict[str, Any], amount: float, payment_date: str) -> Tuple[str, str]:
     html = f"""
     <html><body>
@@ -185,6 +689,7 @@ def render_payment_confirmation_email(user: Dict[str, Any], amount: float, payme
     """
     return html, plain
 
+@profiled_stage('render')
 def render_payment_failed_email(user: Dict[str, Any], due_date: str) -> Tuple[str, str]:
     html = f"""
     <html><body>
@@ -212,6 +717,7 @@ def render_payment_failed_email(user: Dict[str, Any], due_date: str) -> Tuple[st
     """
     return html, plain
 
+@profiled_stage('render')
 def render_subscription_frozen_email(user: Dict[str, Any]) -> Tuple[str, str]:
     html = f"""
     <html><body>
@@ -240,42 +746,326 @@ def render_subscription_frozen_email(user: Dict[str, Any]) -> Tuple[str, str]:
     return html, plain
 
 # --- EVENT-TRIGGERED EMAIL FUNCTIONS ---
-def send_welcome_email(email_sender: EmailSender, user: Dict[str, Any]):
+def send_welcome_email(email_sender: EmailSender, user: Dict[str, Any], max_retries: int = 3):
     html, plain = render_welcome_email(user)
     email_sender.send_email(
         to=[user['email']],
         subject="Welcome to Our Platform",
         html_body=html,
-        plain_body=plain
+        plain_body=plain,
+        max_retries=max_retries
     )
 
-def send_payment_confirmation_email(email_sender: EmailSender, user: Dict[str, Any], amount: float, payment_date: str):
+def send_payment_confirmation_email(email_sender: EmailSender, user: Dict[str, Any], amount: float, payment_date: str, max_retries: int = 3):
     html, plain = render_payment_confirmation_email(user, amount, payment_date)
     email_sender.send_email(
         to=[user['email']],
         subject="Payment Confirmation",
         html_body=html,
-        plain_body=plain
+        plain_body=plain,
+        max_retries=max_retries
     )
 
-def send_payment_failed_email(email_sender: EmailSender, user: Dict[str, Any], due_date: str):
+def send_payment_failed_email(email_sender: EmailSender, user: Dict[str, Any], due_date: str, max_retries: int = 3):
     html, plain = render_payment_failed_email(user, due_date)
     email_sender.send_email(
         to=[user['email']],
         subject="Payment Not Received",
         html_body=html,
-        plain_body=plain
+        plain_body=plain,
+        max_retries=max_retries
     )
 
-def send_subscription_frozen_email(email_sender: EmailSender, user: Dict[str, Any]):
+def send_subscription_frozen_email(email_sender: EmailSender, user: Dict[str, Any], max_retries: int = 3):
     html, plain = render_subscription_frozen_email(user)
     email_sender.send_email(
         to=[user['email']],
         subject="Subscription Frozen",
         html_body=html,
-        plain_body=plain
+        plain_body=plain,
+        max_retries=max_retries
     )
 
+# --- SCHEDULED SENDS ---
+class TimerWheel:
+    """Hierarchical timer wheel holding (timer_id, tick) entries for the near-term window.
+
+    Level 0 has one slot per tick; each higher level covers `slots` times the span of the
+    level below and cascades its entries down as the wheel turns, so scheduling and expiry
+    are O(1) per timer regardless of how many are pending.
+    """
+
+    def __init__(self, resolution: float = 1.0, slots: int = 64, levels: int = 4, start: Optional[float] = None):
+        if resolution <= 0 or slots < 2 or levels < 1:
+            raise ValueError('Invalid timer wheel dimensions')
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self.span = slots ** levels
+        self._wheels: List[List[List[Tuple[int, int]]]] = [[[] for _ in range(slots)] for _ in range(levels)]
+        self._tick = self._to_tick(time.time() if start is None else start)
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def horizon(self) -> float:
+        return (self._tick + self.span - 1) * self.resolution
+
+    def _to_tick(self, when: float) -> int:
+        # Round up so a timer never fires before its due time.
+        return math.ceil(when / self.resolution)
+
+    def schedule(self, timer_id: int, fire_at: float) -> None:
+        tick = max(self._to_tick(fire_at), self._tick)
+        if tick - self._tick >= self.span:
+            raise ValueError('fire_at is beyond the timer wheel horizon')
+        self._place(timer_id, tick)
+        self._count += 1
+
+    def _place(self, timer_id: int, tick: int) -> None:
+        delta = tick - self._tick
+        for level in range(self.levels):
+            if delta < self.slots ** (level + 1):
+                slot = (tick // self.slots ** level) % self.slots
+                self._wheels[level][slot].append((timer_id, tick))
+                return
+
+    def advance(self, now: float) -> List[int]:
+        target = math.floor(now / self.resolution)
+        expired: List[int] = []
+        while self._tick <= target:
+            for level in range(self.levels - 1, 0, -1):
+                width = self.slots ** level
+                if self._tick % width == 0:
+                    slot = (self._tick // width) % self.slots
+                    bucket, self._wheels[level][slot] = self._wheels[level][slot], []
+                    for timer_id, tick in bucket:
+                        self._place(timer_id, tick)
+            slot = self._tick % self.slots
+            bucket, self._wheels[0][slot] = self._wheels[0][slot], []
+            expired.extend(timer_id for timer_id, _ in bucket)
+            self._tick += 1
+        self._count -= len(expired)
+        return expired
+
+EMAIL_TYPES = {
+    'welcome': send_welcome_email,
+    'payment_confirmation': send_payment_confirmation_email,
+    'payment_failed': send_payment_failed_email,
+    'subscription_frozen': send_subscription_frozen_email,
+}
+
+def _to_epoch(when: Any) -> float:
+    if isinstance(when, datetime):
+        return when.timestamp()
+    if isinstance(when, date):
+        return datetime(when.year, when.month, when.day).timestamp()
+    if isinstance(when, str):
+        return datetime.fromisoformat(when).timestamp()
+    return float(when)
+
+class EmailScheduler:
+    """Persists future sends in SQL and dispatches them when due.
+
+    Pending rows live in `scheduled_emails`, indexed by fire time. Only rows due within
+    `window` seconds are loaded into the in-memory TimerWheel, so startup and refills are
+    index range scans rather than a scan of users. Each run_pending also picks up rows
+    inserted since the last call (by id, via the primary key), so sends scheduled from
+    other processes are seen even when they are due inside the loaded window.
+
+    Only ONE process may dispatch (call run_pending) against a table at a time; any number
+    may schedule and cancel. Each row is claimed ('pending' -> 'sending') and committed
+    before its send and marked 'sent' after it, so a cancel that lands first always wins
+    and a crash of the dispatcher re-sends nothing. At startup, rows left in 'sending'
+    are marked 'failed' rather than risk a duplicate, which is only correct because no
+    other dispatcher can be mid-send. Rows store only the user id; the user is re-read
+    through `data_access` when the send fires. Transient SMTP/OS errors are rescheduled
+    with exponential backoff up to `max_attempts`.
+    """
+
+    def __init__(self, data_access: 'SQLDataAccess', email_sender: 'EmailSender', window: float = 3600.0,
+                 batch_size: int = 500, resolution: float = 1.0, max_attempts: int = 5,
+                 retry_backoff: float = 300.0, now: Optional[float] = None):
+        self.data_access = data_access
+        self.conn = data_access.conn
+        self.email_sender = email_sender
+        self.window = window
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        now = time.time() if now is None else now
+        self.wheel = TimerWheel(resolution=resolution, start=now)
+        if window >= self.wheel.span * resolution:
+            raise ValueError('window must be shorter than the timer wheel horizon')
+        self._loaded_until: Optional[float] = None
+        self._max_seen_id = 0
+        self._ensure_schema()
+        self._recover_interrupted()
+        self._refill(now)
+
+    def _ensure_schema(self) -> None:
+        cur = self.conn.cursor()
+        cur.execute('''CREATE TABLE IF NOT EXISTS scheduled_emails (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fire_at REAL NOT NULL,
+            email_type TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            params_json TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error_message TEXT,
+            created_at REAL NOT NULL
+        )''')
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_emails_pending ON scheduled_emails (fire_at) WHERE status = 'pending'")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_emails_user ON scheduled_emails (user_id)")
+        self.conn.commit()
+
+    def _recover_interrupted(self) -> None:
+        cur = self.conn.cursor()
+        cur.execute("UPDATE scheduled_emails SET status = 'failed', error_message = ? WHERE status = 'sending'",
+                    ('Interrupted while sending; not retried to avoid a duplicate',))
+        self.conn.commit()
+        if cur.rowcount:
+            logger.warning(f"{cur.rowcount} scheduled email(s) were interrupted mid-send and marked failed")
+
+    def schedule(self, email_type: str, user_id: int, fire_at: Any, **params: Any) -> int:
+        if email_type not in EMAIL_TYPES:
+            raise ValueError(f"Unknown email type: {email_type}")
+        fire_at = _to_epoch(fire_at)
+        cur = self.conn.cursor()
+        cur.execute('''INSERT INTO scheduled_emails (fire_at, email_type, user_id, params_json, created_at)
+                       VALUES (?, ?, ?, ?, ?)''',
+                    (fire_at, email_type, user_id, json.dumps(params), time.time()))
+        self.conn.commit()
+        # Loaded by the next run_pending, the same way as rows from other processes.
+        return cur.lastrowid
+
+    def cancel(self, timer_id: int) -> bool:
+        cur = self.conn.cursor()
+        cur.execute("UPDATE scheduled_emails SET status = 'cancelled' WHERE id = ? AND status = 'pending'", (timer_id,))
+        self.conn.commit()
+        return cur.rowcount > 0
+
+    def cancel_for_user(self, user_id: int, email_type: Optional[str] = None) -> int:
+        cur = self.conn.cursor()
+        if email_type is None:
+            cur.execute("UPDATE scheduled_emails SET status = 'cancelled' WHERE user_id = ? AND status = 'pending'", (user_id,))
+        else:
+            cur.execute("UPDATE scheduled_emails SET status = 'cancelled' WHERE user_id = ? AND email_type = ? AND status = 'pending'",
+                        (user_id, email_type))
+        self.conn.commit()
+        return cur.rowcount
+
+    def _refill(self, now: float) -> None:
+        until = now + self.window
+        cur = self.conn.cursor()
+        if self._loaded_until is None:
+            self._max_seen_id = self._max_id()
+            cur.execute("SELECT id, fire_at FROM scheduled_emails WHERE status = 'pending' AND fire_at < ?", (until,))
+        else:
+            cur.execute("SELECT id, fire_at FROM scheduled_emails WHERE status = 'pending' AND fire_at >= ? AND fire_at < ?",
+                        (self._loaded_until, until))
+        for timer_id, fire_at in cur:
+            self.wheel.schedule(timer_id, fire_at)
+        self._loaded_until = until
+
+    def _max_id(self) -> int:
+        cur = self.conn.cursor()
+        cur.execute("SELECT COALESCE(MAX(id), 0) FROM scheduled_emails")
+        return cur.fetchone()[0]
+
+    def _load_new_rows(self) -> None:
+        # Ids only grow and SQLite commits writers one at a time, so everything not yet
+        # seen has an id above the watermark.
+        max_id = self._max_id()
+        if max_id <= self._max_seen_id:
+            return
+        cur = self.conn.cursor()
+        cur.execute('''SELECT id, fire_at FROM scheduled_emails
+                       WHERE id > ? AND id <= ? AND status = 'pending' AND fire_at < ?''',
+                    (self._max_seen_id, max_id, self._loaded_until))
+        for timer_id, fire_at in cur:
+            self.wheel.schedule(timer_id, fire_at)
+        self._max_seen_id = max_id
+
+    def run_pending(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        self._load_new_rows()
+        if now + self.window / 2 >= self._loaded_until:
+            self._refill(now)
+        due = self.wheel.advance(now)
+        sent = 0
+        for i in range(0, len(due), self.batch_size):
+            sent += self._dispatch(due[i:i + self.batch_size], now)
+        return sent
+
+    def _dispatch(self, timer_ids: List[int], now: float) -> int:
+        cur = self.conn.cursor()
+        placeholders = ', '.join('?' * len(timer_ids))
+        cur.execute(f'''SELECT id, email_type, user_id, params_json, attempts FROM scheduled_emails
+                        WHERE id IN ({placeholders}) AND status = 'pending' ORDER BY fire_at''', timer_ids)
+        sent = 0
+        for timer_id, email_type, user_id, params_json, attempts in cur.fetchall():
+            if not self._claim(timer_id, now):
+                # Cancelled (or claimed elsewhere) since the batch was read.
+                continue
+            user = self.data_access.get_user_by_id(user_id)
+            if user is None:
+                self._set_status(timer_id, 'skipped', 'User no longer exists')
+                continue
+            try:
+                # One attempt per firing: retries are rescheduled below instead of
+                # sleeping inside send_email and stalling the rest of the batch.
+                EMAIL_TYPES[email_type](self.email_sender, user, max_retries=1, **json.loads(params_json))
+            except (smtplib.SMTPException, OSError) as e:
+                self._retry_or_fail(timer_id, email_type, attempts + 1, e, now)
+                continue
+            except Exception as e:
+                logger.error(f"Scheduled email {timer_id} ({email_type}) failed: {e}")
+                self._set_status(timer_id, 'failed', str(e))
+                continue
+            self._set_status(timer_id, 'sent', None)
+            sent += 1
+        return sent
+
+    def _retry_or_fail(self, timer_id: int, email_type: str, attempts: int, error: Exception, now: float) -> None:
+        code = _smtp_reply_code(error)
+        permanent = code is not None and 500 <= code < 600
+        if permanent or attempts >= self.max_attempts:
+            logger.error(f"Scheduled email {timer_id} ({email_type}) failed after {attempts} attempt(s): {error}")
+            self._set_status(timer_id, 'failed', str(error))
+            return
+        fire_at = now + self.retry_backoff * 2 ** (attempts - 1)
+        logger.warning(f"Scheduled email {timer_id} ({email_type}) attempt {attempts} failed, retrying at {fire_at:.0f}: {error}")
+        cur = self.conn.cursor()
+        cur.execute("UPDATE scheduled_emails SET status = 'pending', attempts = ?, fire_at = ?, error_message = ? WHERE id = ?",
+                    (attempts, fire_at, str(error), timer_id))
+        self.conn.commit()
+        if fire_at < self._loaded_until:
+            self.wheel.schedule(timer_id, fire_at)
+
+    def _claim(self, timer_id: int, now: float) -> bool:
+        # fire_at guards against a duplicate wheel entry for a row already rescheduled.
+        cur = self.conn.cursor()
+        cur.execute('''UPDATE scheduled_emails SET status = 'sending', error_message = NULL
+                       WHERE id = ? AND status = 'pending' AND fire_at <= ?''', (timer_id, now))
+        self.conn.commit()
+        return cur.rowcount > 0
+
+    def _set_status(self, timer_id: int, status: str, error_message: Optional[str]) -> None:
+        cur = self.conn.cursor()
+        cur.execute("UPDATE scheduled_emails SET status = ?, error_message = ? WHERE id = ?", (status, error_message, timer_id))
+        self.conn.commit()
+
+def schedule_payment_failed_followups(scheduler: EmailScheduler, user: Dict[str, Any], due_date: str,
+                                      frozen_after_days: int = 7) -> Tuple[int, int]:
+    due = date.fromisoformat(due_date)
+    reminder_id = scheduler.schedule('payment_failed', user['id'], due, due_date=due_date)
+    frozen_id = scheduler.schedule('subscription_frozen', user['id'], due + timedelta(days=frozen_after_days))
+    return reminder_id, frozen_id
+
 # --- EXAMPLE USAGE ---
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
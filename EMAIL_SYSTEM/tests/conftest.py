@@ -6,7 +6,9 @@ import sqlite3
 def clean_env(monkeypatch):
     for var in [
         "SMTP_HOST", "SMTP_PORT", "SMTP_USERNAME", "SMTP_PASSWORD",
-        "SMTP_USE_TLS", "SMTP_USE_SSL", "FROM_EMAIL", "FROM_NAME", "DB_URL"
+        "SMTP_USE_TLS", "SMTP_USE_SSL", "FROM_EMAIL", "FROM_NAME", "DB_URL",
+        "SMTP_MAX_CONCURRENCY", "SMTP_MAX_RATE", "SMTP_PIPELINING",
+        "EMAIL_PROFILE", "EMAIL_PROFILE_SENDS", "EMAIL_PROFILE_DIR"
     ]:
         monkeypatch.delenv(var, raising=False)
 
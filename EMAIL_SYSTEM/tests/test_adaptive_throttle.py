@@ -0,0 +1,86 @@
+import smtplib
+import pytest
+from unittest import mock
+import no_reply_email_system
+
+@pytest.fixture(autouse=True)
+def fresh_throttles(monkeypatch):
+    monkeypatch.setattr(no_reply_email_system, "_relay_throttles", {})
+
+@pytest.fixture
+def sender(smtp_env):
+    return no_reply_email_system.EmailSender()
+
+def test_throttle_code_decreases_multiplicatively():
+    throttle = no_reply_email_system.AdaptiveThrottle(max_concurrency=8, max_rate=40.0)
+    throttle.acquire()
+    throttle.release(421, 0.1)
+    assert throttle.concurrency == 4
+    assert throttle.rate == 20.0
+
+def test_decrease_only_once_per_cooldown():
+    throttle = no_reply_email_system.AdaptiveThrottle(max_concurrency=8, cooldown=60.0)
+    for _ in range(3):
+        throttle.acquire()
+        throttle.release(451, 0.1)
+    assert throttle.concurrency == 4
+
+def test_healthy_replies_increase_additively():
+    throttle = no_reply_email_system.AdaptiveThrottle(max_concurrency=8, max_rate=40.0, rate_step=1.0)
+    throttle.concurrency = 2.0
+    throttle.rate = 10.0
+    throttle.acquire()
+    throttle.release(250, 0.1)
+    assert throttle.concurrency == 2.5
+    assert throttle.rate == 11.0
+
+def test_slow_or_failed_replies_hold_limits():
+    throttle = no_reply_email_system.AdaptiveThrottle(max_concurrency=8, latency_target=1.0)
+    throttle.concurrency = 2.0
+    throttle.acquire()
+    throttle.release(250, 5.0)
+    throttle.acquire()
+    throttle.release(550, 0.1)
+    throttle.acquire()
+    throttle.release(None, 0.1)
+    assert throttle.concurrency == 2.0
+    assert throttle.in_flight == 0
+
+def test_senders_share_throttle_per_relay(smtp_env):
+    a = no_reply_email_system.EmailSender()
+    b = no_reply_email_system.EmailSender()
+    assert a.throttle is b.throttle
+
+@mock.patch("time.sleep")
+@mock.patch("smtplib.SMTP")
+def test_send_email_backs_off_on_421(mock_smtp, mock_sleep, sender, demo_user):
+    instance = mock_smtp.return_value.__enter__.return_value
+    instance.send_message.side_effect = [smtplib.SMTPResponseException(421, b"Too many connections"), None]
+    sender.send_email(to=[demo_user["email"]], subject="Hi", html_body="<b>Hi</b>")
+    assert instance.send_message.call_count == 2
+    assert sender.throttle.concurrency < sender.throttle.max_concurrency
+    assert sender.throttle.rate < sender.throttle.max_rate
+    assert sender.throttle.in_flight == 0
+
+@mock.patch("smtplib.SMTP")
+def test_unexpected_error_releases_slot(mock_smtp, smtp_env, monkeypatch, demo_user):
+    monkeypatch.setenv("SMTP_MAX_CONCURRENCY", "1")
+    sender = no_reply_email_system.EmailSender()
+    instance = mock_smtp.return_value.__enter__.return_value
+    instance.send_message.side_effect = [ValueError("bad message"), None]
+    with pytest.raises(ValueError):
+        sender.send_email(to=[demo_user["email"]], subject="Hi", html_body="<b>Hi</b>")
+    assert sender.throttle.in_flight == 0
+    sender.send_email(to=[demo_user["email"]], subject="Hi", html_body="<b>Hi</b>")
+    assert sender.throttle.in_flight == 0
+
+def test_later_sender_updates_bounds(smtp_env, monkeypatch):
+    first = no_reply_email_system.EmailSender()
+    assert first.throttle.max_concurrency == 8
+    monkeypatch.setenv("SMTP_MAX_CONCURRENCY", "2")
+    monkeypatch.setenv("SMTP_MAX_RATE", "5")
+    second = no_reply_email_system.EmailSender()
+    assert second.throttle is first.throttle
+    assert first.throttle.max_concurrency == 2
+    assert first.throttle.concurrency == 2.0
+    assert first.throttle.rate == 5.0
@@ -0,0 +1,133 @@
+import smtplib
+import socket
+import threading
+import pytest
+from unittest import mock
+import no_reply_email_system
+
+def make_transport(features, replies):
+    server = no_reply_email_system.PipeliningSMTP()
+    server.ehlo_resp = b"ok"
+    server.does_esmtp = True
+    server.esmtp_features = dict.fromkeys(features, "")
+    server.written = []
+    server.send = server.written.append
+    server.getreply = mock.Mock(side_effect=replies)
+    server.rset = mock.Mock()
+    return server
+
+def test_chunking_sends_whole_transaction_in_one_write():
+    server = make_transport(
+        ["pipelining", "chunking"],
+        [(250, b"ok"), (250, b"ok"), (250, b"ok"), (250, b"queued")],
+    )
+    refused = server.sendmail("no-reply@test.local", ["a@test.local", "b@test.local"], b"Subject: x\n\nhi\n")
+    assert refused == {}
+    assert len(server.written) == 1
+    assert server.written[0] == (
+        b"MAIL FROM:<no-reply@test.local>\r\n"
+        b"RCPT TO:<a@test.local>\r\n"
+        b"RCPT TO:<b@test.local>\r\n"
+        b"BDAT 18 LAST\r\n"
+        b"Subject: x\r\n\r\nhi\r\n"
+    )
+
+def test_pipelined_data_reports_per_recipient_results():
+    server = make_transport(
+        ["pipelining", "size"],
+        [(250, b"ok"), (250, b"ok"), (550, b"no such user"), (354, b"go"), (250, b"queued")],
+    )
+    refused = server.sendmail("no-reply@test.local", ["a@test.local", "b@test.local"], b".dot\n")
+    assert refused == {"b@test.local": (550, b"no such user")}
+    assert server.rcpt_replies["a@test.local"] == (250, b"ok")
+    assert len(server.written) == 2
+    assert server.written[0].startswith(b"MAIL FROM:<no-reply@test.local> SIZE=6\r\n")
+    assert server.written[0].endswith(b"DATA\r\n")
+    assert server.written[1] == b"..dot\r\n.\r\n"
+
+def test_all_recipients_refused_raises():
+    server = make_transport(
+        ["pipelining"],
+        [(250, b"ok"), (451, b"try later"), (554, b"no valid recipients")],
+    )
+    with pytest.raises(smtplib.SMTPRecipientsRefused) as e:
+        server.sendmail("no-reply@test.local", ["a@test.local"], b"hi\n")
+    assert e.value.recipients == {"a@test.local": (451, b"try later")}
+    server.rset.assert_called_once()
+
+def test_sender_refused_421_stops_reading_replies():
+    server = make_transport(
+        ["pipelining", "chunking"],
+        [(421, b"too busy"), smtplib.SMTPServerDisconnected("Connection unexpectedly closed")],
+    )
+    server.close = mock.Mock()
+    with pytest.raises(smtplib.SMTPSenderRefused) as e:
+        server.sendmail("no-reply@test.local", ["a@test.local"], b"hi\n")
+    assert e.value.smtp_code == 421
+    server.close.assert_called_once()
+
+def test_recipient_421_raises_recipients_refused():
+    server = make_transport(
+        ["pipelining"],
+        [(250, b"ok"), (250, b"ok"), (421, b"too busy"), smtplib.SMTPServerDisconnected("closed")],
+    )
+    server.close = mock.Mock()
+    with pytest.raises(smtplib.SMTPRecipientsRefused) as e:
+        server.sendmail("no-reply@test.local", ["a@test.local", "b@test.local", "c@test.local"], b"hi\n")
+    assert e.value.recipients == {"b@test.local": (421, b"too busy")}
+    assert no_reply_email_system._smtp_reply_code(e.value) == 421
+
+def test_421_then_real_disconnect_keeps_reply_code():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+
+    def relay():
+        conn, _ = listener.accept()
+        with conn:
+            conn.sendall(b"220 relay.test ESMTP\r\n")
+            conn.recv(1024)
+            conn.sendall(b"250-relay.test\r\n250-PIPELINING\r\n250 CHUNKING\r\n")
+            received = b""
+            while b"MAIL FROM" not in received:
+                received += conn.recv(4096)
+            conn.sendall(b"421 4.7.0 Too many connections\r\n")
+        listener.close()
+
+    thread = threading.Thread(target=relay, daemon=True)
+    thread.start()
+    server = no_reply_email_system.PipeliningSMTP("127.0.0.1", listener.getsockname()[1], timeout=5)
+    with pytest.raises(smtplib.SMTPSenderRefused) as e:
+        server.sendmail("no-reply@test.local", ["a@test.local", "b@test.local"], b"hi\n")
+    thread.join(5)
+    assert no_reply_email_system._smtp_reply_code(e.value) == 421
+    assert server.sock is None
+
+@mock.patch.object(no_reply_email_system, "PipeliningSMTP")
+def test_sender_uses_pipelining_transport_when_enabled(mock_transport, smtp_env, monkeypatch, demo_user):
+    monkeypatch.setenv("SMTP_PIPELINING", "true")
+    sender = no_reply_email_system.EmailSender()
+    instance = mock_transport.return_value.__enter__.return_value
+    sender.send_email(to=[demo_user["email"]], subject="Hi", html_body="<b>Hi</b>")
+    instance.send_message.assert_called_once()
+
+@mock.patch("smtplib.SMTP")
+def test_session_reuses_one_connection(mock_smtp, smtp_env, demo_user):
+    sender = no_reply_email_system.EmailSender()
+    server = mock_smtp.return_value
+    with sender.session():
+        for _ in range(3):
+            sender.send_email(to=[demo_user["email"]], subject="Hi", html_body="<b>Hi</b>")
+    assert mock_smtp.call_count == 1
+    assert server.send_message.call_count == 3
+    server.starttls.assert_called_once()
+    server.quit.assert_called_once()
+
+@mock.patch("smtplib.SMTP")
+def test_session_reconnects_after_relay_closes(mock_smtp, smtp_env, demo_user):
+    sender = no_reply_email_system.EmailSender()
+    with sender.session():
+        sender.send_email(to=[demo_user["email"]], subject="Hi", html_body="<b>Hi</b>")
+        mock_smtp.return_value.sock = None
+        sender.send_email(to=[demo_user["email"]], subject="Hi", html_body="<b>Hi</b>")
+    assert mock_smtp.call_count == 2
@@ -0,0 +1,93 @@
+import pstats
+import threading
+import time
+import pytest
+from unittest import mock
+import no_reply_email_system
+
+@pytest.fixture
+def sender(smtp_env):
+    return no_reply_email_system.EmailSender()
+
+@pytest.fixture(autouse=True)
+def stop_profiler():
+    yield
+    no_reply_email_system.disable_profiling()
+
+def slow_send(msg):
+    time.sleep(0.03)
+
+@mock.patch("smtplib.SMTP")
+def test_sampling_profiler_stops_after_window(mock_smtp, sender, demo_user, tmp_path):
+    mock_smtp.return_value.__enter__.return_value.send_message.side_effect = slow_send
+    profiler = no_reply_email_system.enable_profiling(sends=2, mode="sample", interval=0.001, output_dir=str(tmp_path))
+    no_reply_email_system.send_welcome_email(sender, demo_user)
+    no_reply_email_system.send_subscription_frozen_email(sender, demo_user)
+    assert no_reply_email_system._active_profiler is None
+    assert profiler.completed_sends == 2
+    assert set(profiler.stage_times) == {"render", "send_email", "smtp"}
+    lines = open(profiler.outputs["collapsed"], encoding="utf-8").read().splitlines()
+    assert lines
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        assert int(count) > 0
+    assert any("[send_email];" in line and "[smtp];" in line for line in lines)
+    stages = open(profiler.outputs["stages"], encoding="utf-8").read()
+    assert "send_email\t2\t" in stages
+
+@mock.patch("smtplib.SMTP")
+def test_cprofile_mode_writes_pstats(mock_smtp, sender, tmp_path):
+    profiler = no_reply_email_system.enable_profiling(sends=1, mode="cprofile", output_dir=str(tmp_path))
+    sender.send_email(to=["user1@test.local"], subject="Hi", html_body="<p>Hi</p>")
+    stats = pstats.Stats(profiler.outputs["cprofile"])
+    assert any(func[2] == "html_to_text" for func in stats.stats)
+    assert profiler.stage_times["html_to_text"][0] == 1
+
+def test_disable_profiling_and_double_enable(tmp_path):
+    no_reply_email_system.enable_profiling(sends=5, output_dir=str(tmp_path))
+    with pytest.raises(RuntimeError):
+        no_reply_email_system.enable_profiling(sends=5, output_dir=str(tmp_path))
+    outputs = no_reply_email_system.disable_profiling()
+    assert set(outputs) == {"collapsed", "stages"}
+    assert no_reply_email_system.disable_profiling() == {}
+
+@pytest.mark.parametrize("value, mode", [("1", "sample"), ("true", "sample"), ("cprofile", "cprofile"), ("bogus", None), ("off", None)])
+def test_profiling_env_flag_never_breaks_startup(monkeypatch, tmp_path, value, mode):
+    monkeypatch.setenv("EMAIL_PROFILE", value)
+    monkeypatch.setenv("EMAIL_PROFILE_DIR", str(tmp_path))
+    profiler = no_reply_email_system._profiling_from_env()
+    assert (profiler.mode if profiler else None) == mode
+
+def test_disable_from_other_thread_does_not_block(tmp_path):
+    entered, release = threading.Event(), threading.Event()
+
+    @no_reply_email_system.profiled_stage("send_email")
+    def busy_send():
+        entered.set()
+        release.wait(5)
+
+    profiler = no_reply_email_system.enable_profiling(sends=5, mode="cprofile", output_dir=str(tmp_path), max_seconds=60)
+    worker = threading.Thread(target=busy_send)
+    worker.start()
+    entered.wait(5)
+    started = time.monotonic()
+    outputs = no_reply_email_system.disable_profiling()
+    assert time.monotonic() - started < 1
+    assert no_reply_email_system._active_profiler is None
+    assert "stages" in outputs
+    release.set()
+    worker.join(5)
+    assert "cprofile" in profiler.outputs
+    pstats.Stats(profiler.outputs["cprofile"])
+
+@pytest.mark.parametrize("mode", ["sample", "cprofile"])
+@mock.patch("smtplib.SMTP")
+def test_unwritable_output_dir_does_not_fail_send(mock_smtp, mode, sender, demo_user, tmp_path):
+    blocker = tmp_path / "not_a_dir"
+    blocker.write_text("")
+    instance = mock_smtp.return_value.__enter__.return_value
+    profiler = no_reply_email_system.enable_profiling(sends=1, mode=mode, output_dir=str(blocker / "profiles"))
+    sender.send_email(to=[demo_user["email"]], subject="Hi", html_body="<b>Hi</b>")
+    instance.send_message.assert_called_once()
+    assert no_reply_email_system._active_profiler is None
+    assert profiler.outputs == {}
@@ -0,0 +1,180 @@
+import smtplib
+from datetime import datetime
+from unittest import mock
+import pytest
+import no_reply_email_system
+
+T0 = 1_000_000.0
+
+@pytest.fixture
+def data_access(temp_db, monkeypatch):
+    monkeypatch.setenv("DB_URL", "sqlite:///:memory:")
+    db = no_reply_email_system.SQLDataAccess()
+    db.conn = temp_db
+    return db
+
+@pytest.fixture
+def email_sender():
+    return mock.Mock(spec=no_reply_email_system.EmailSender)
+
+def statuses(conn):
+    return [row[0] for row in conn.execute("SELECT status FROM scheduled_emails ORDER BY id")]
+
+def test_timer_wheel_fires_across_levels_in_order():
+    wheel = no_reply_email_system.TimerWheel(resolution=1.0, slots=4, levels=3, start=T0)
+    for timer_id, delay in [(1, 0), (2, 3), (3, 5), (4, 17), (5, 40)]:
+        wheel.schedule(timer_id, T0 + delay)
+    assert len(wheel) == 5
+    fired = {}
+    for step in range(64):
+        for timer_id in wheel.advance(T0 + step):
+            fired[timer_id] = step
+    assert fired == {1: 0, 2: 3, 3: 5, 4: 17, 5: 40}
+    assert len(wheel) == 0
+
+def test_timer_wheel_rejects_beyond_horizon():
+    wheel = no_reply_email_system.TimerWheel(resolution=1.0, slots=4, levels=2, start=T0)
+    with pytest.raises(ValueError):
+        wheel.schedule(1, T0 + 16)
+
+def test_scheduler_dispatches_with_current_user(data_access, email_sender, demo_user):
+    scheduler = no_reply_email_system.EmailScheduler(data_access, email_sender, window=60, now=T0)
+    with mock.patch.dict(no_reply_email_system.EMAIL_TYPES, {"payment_failed": mock.Mock()}) as types:
+        scheduler.schedule("payment_failed", demo_user["id"], T0 + 10, due_date="2025-12-28")
+        data_access.conn.execute("UPDATE users SET email = 'new@test.local' WHERE id = 1")
+        assert scheduler.run_pending(T0 + 9) == 0
+        assert scheduler.run_pending(T0 + 10) == 1
+        user = types["payment_failed"].call_args.args[1]
+        assert user["email"] == "new@test.local"
+        assert types["payment_failed"].call_args.kwargs == {"max_retries": 1, "due_date": "2025-12-28"}
+    assert statuses(data_access.conn) == ["sent"]
+
+def test_scheduler_survives_restart_and_loads_only_window(data_access, email_sender, demo_user):
+    scheduler = no_reply_email_system.EmailScheduler(data_access, email_sender, window=60, now=T0)
+    scheduler.schedule("subscription_frozen", demo_user["id"], T0 + 30)
+    scheduler.schedule("subscription_frozen", demo_user["id"], T0 + 3600)
+    restarted = no_reply_email_system.EmailScheduler(data_access, email_sender, window=60, now=T0 + 20)
+    assert len(restarted.wheel) == 1
+    with mock.patch.dict(no_reply_email_system.EMAIL_TYPES, {"subscription_frozen": mock.Mock()}):
+        assert restarted.run_pending(T0 + 30) == 1
+        for step in range(60, 3601, 30):
+            restarted.run_pending(T0 + step)
+    assert statuses(data_access.conn) == ["sent", "sent"]
+
+def test_crash_mid_batch_does_not_resend(data_access, email_sender, demo_user):
+    scheduler = no_reply_email_system.EmailScheduler(data_access, email_sender, window=60, now=T0)
+    for _ in range(3):
+        scheduler.schedule("welcome", demo_user["id"], T0 + 1)
+    crashing = mock.Mock(side_effect=[None, KeyboardInterrupt, None])
+    with mock.patch.dict(no_reply_email_system.EMAIL_TYPES, {"welcome": crashing}):
+        with pytest.raises(KeyboardInterrupt):
+            scheduler.run_pending(T0 + 1)
+        assert statuses(data_access.conn) == ["sent", "sending", "pending"]
+        restarted = no_reply_email_system.EmailScheduler(data_access, email_sender, window=60, now=T0 + 2)
+        assert restarted.run_pending(T0 + 2) == 1
+    assert statuses(data_access.conn) == ["sent", "failed", "sent"]
+    assert crashing.call_count == 3
+
+def test_transient_failure_is_rescheduled(data_access, email_sender, demo_user):
+    scheduler = no_reply_email_system.EmailScheduler(data_access, email_sender, window=600,
+                                                     retry_backoff=10, max_attempts=2, now=T0)
+    flaky = mock.Mock(side_effect=[smtplib.SMTPServerDisconnected("relay down"), None])
+    with mock.patch.dict(no_reply_email_system.EMAIL_TYPES, {"welcome": flaky}):
+        scheduler.schedule("welcome", demo_user["id"], T0 + 1)
+        assert scheduler.run_pending(T0 + 1) == 0
+        row = data_access.conn.execute("SELECT status, attempts, fire_at FROM scheduled_emails").fetchone()
+        assert row == ("pending", 1, T0 + 11)
+        assert scheduler.run_pending(T0 + 10) == 0
+        assert scheduler.run_pending(T0 + 11) == 1
+    assert statuses(data_access.conn) == ["sent"]
+
+def test_permanent_and_unexpected_failures(data_access, email_sender, demo_user):
+    scheduler = no_reply_email_system.EmailScheduler(data_access, email_sender, window=60, now=T0)
+    failing = mock.Mock(side_effect=[smtplib.SMTPRecipientsRefused({"a@test.local": (550, b"no such user")}),
+                                     RuntimeError("template bug")])
+    with mock.patch.dict(no_reply_email_system.EMAIL_TYPES, {"welcome": failing}):
+        cancelled = scheduler.schedule("welcome", demo_user["id"], T0 + 1)
+        scheduler.schedule("welcome", demo_user["id"], T0 + 1)
+        scheduler.schedule("welcome", demo_user["id"], T0 + 1)
+        scheduler.schedule("welcome", 999, T0 + 1)
+        assert scheduler.cancel(cancelled)
+        assert scheduler.run_pending(T0 + 1) == 0
+    rows = data_access.conn.execute("SELECT status, error_message FROM scheduled_emails ORDER BY id").fetchall()
+    assert [status for status, _ in rows] == ["cancelled", "failed", "failed", "skipped"]
+    assert rows[2][1] == "template bug"
+
+def test_payment_failed_followups_with_date_columns(tmp_path, email_sender, monkeypatch):
+    monkeypatch.setenv("DB_URL", f"sqlite:///{tmp_path / 'app.db'}")
+    db = no_reply_email_system.SQLDataAccess()
+    db.conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, email TEXT, name TEXT, "
+                    "subscription_status TEXT, last_payment_date DATE)")
+    db.conn.execute("INSERT INTO users VALUES (1, 'user1@test.local', 'User One', 'active', '2025-12-01')")
+    user = db.get_user_by_id(1)
+    scheduler = no_reply_email_system.EmailScheduler(db, email_sender, window=60, now=T0)
+    no_reply_email_system.schedule_payment_failed_followups(scheduler, user, "2025-12-28", frozen_after_days=7)
+    rows = db.conn.execute("SELECT email_type, fire_at FROM scheduled_emails ORDER BY fire_at").fetchall()
+    assert rows == [
+        ("payment_failed", datetime(2025, 12, 28).timestamp()),
+        ("subscription_frozen", datetime(2026, 1, 4).timestamp()),
+    ]
+    assert scheduler.cancel_for_user(user["id"]) == 2
+    db.close()
+
+def test_cancel_from_other_connection_during_batch(tmp_path, email_sender, monkeypatch):
+    db_path = tmp_path / "app.db"
+    monkeypatch.setenv("DB_URL", f"sqlite:///{db_path}")
+    db = no_reply_email_system.SQLDataAccess()
+    db.conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, email TEXT, name TEXT, "
+                    "subscription_status TEXT, last_payment_date TEXT)")
+    db.conn.execute("INSERT INTO users VALUES (1, 'user1@test.local', 'User One', 'active', '2025-12-01')")
+    db.conn.commit()
+    scheduler = no_reply_email_system.EmailScheduler(db, email_sender, window=60, now=T0)
+    first = scheduler.schedule("welcome", 1, T0 + 1)
+    second = scheduler.schedule("subscription_frozen", 1, T0 + 1)
+    web = no_reply_email_system.SQLDataAccess()
+    web_scheduler = no_reply_email_system.EmailScheduler(web, email_sender, window=60, now=T0)
+
+    def send_first(sender, user, max_retries):
+        assert web_scheduler.cancel(second)
+
+    frozen = mock.Mock()
+    with mock.patch.dict(no_reply_email_system.EMAIL_TYPES, {"welcome": send_first, "subscription_frozen": frozen}):
+        assert scheduler.run_pending(T0 + 1) == 1
+    frozen.assert_not_called()
+    assert statuses(db.conn) == ["sent", "cancelled"]
+    web.close()
+    db.close()
+
+@mock.patch("time.sleep")
+@mock.patch("smtplib.SMTP")
+def test_relay_outage_does_not_sleep_in_dispatch(mock_smtp, mock_sleep, data_access, smtp_env, demo_user, monkeypatch):
+    monkeypatch.setattr(no_reply_email_system, "_relay_throttles", {})
+    mock_smtp.side_effect = ConnectionRefusedError("relay down")
+    sender = no_reply_email_system.EmailSender()
+    scheduler = no_reply_email_system.EmailScheduler(data_access, sender, window=60, now=T0)
+    for _ in range(3):
+        scheduler.schedule("welcome", demo_user["id"], T0 + 1)
+    assert scheduler.run_pending(T0 + 1) == 0
+    assert mock_smtp.call_count == 3
+    # Only the throttle's sub-second pacing; no send_email retry backoff.
+    assert all(call.args[0] < 1 for call in mock_sleep.call_args_list)
+    assert statuses(data_access.conn) == ["pending"] * 3
+
+def test_rows_from_other_process_inside_loaded_window(tmp_path, email_sender, monkeypatch):
+    monkeypatch.setenv("DB_URL", f"sqlite:///{tmp_path / 'app.db'}")
+    db = no_reply_email_system.SQLDataAccess()
+    db.conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, email TEXT, name TEXT, "
+                    "subscription_status TEXT, last_payment_date TEXT)")
+    db.conn.execute("INSERT INTO users VALUES (1, 'user1@test.local', 'User One', 'active', '2025-12-01')")
+    db.conn.commit()
+    dispatcher = no_reply_email_system.EmailScheduler(db, email_sender, window=600, now=T0)
+    web = no_reply_email_system.SQLDataAccess()
+    web_scheduler = no_reply_email_system.EmailScheduler(web, email_sender, window=600, now=T0)
+    web_scheduler.schedule("welcome", 1, T0 + 5)
+    with mock.patch.dict(no_reply_email_system.EMAIL_TYPES, {"welcome": mock.Mock()}) as types:
+        assert dispatcher.run_pending(T0 + 5) == 1
+        assert dispatcher.run_pending(T0 + 6) == 0
+        types["welcome"].assert_called_once()
+    assert statuses(db.conn) == ["sent"]
+    web.close()
+    db.close()